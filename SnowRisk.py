@@ -14,6 +14,8 @@
  """
 
 import arcpy
+import bisect
+import collections
 import os
 import traceback
 import math
@@ -23,12 +25,14 @@ import Logging
 
 # Environment
 arcpy.env.overwriteOutput = True
+arcpy.env.parallelProcessingFactor = str(max(1, (os.cpu_count() or 2) - 1))  # Leave one core free for the script itself
 
 # Paths
 fgdb_services = r"F:\Shares\FGDB_Services"
 data = os.path.join(fgdb_services, "Data")
 risk_fgdb = os.path.join(data, "SnowRisk.gdb")
 snow_risk = os.path.join(risk_fgdb, "SnowRisk")
+snow_risk_memory = os.path.join("memory", "SnowRisk")
 snow_rank = os.path.join(risk_fgdb, "SnowRank")
 snow_risk_minor = os.path.join(risk_fgdb, "SnowRiskMinor")
 snow_risk_minor_dissolved = os.path.join(risk_fgdb, "SnowRiskMinor_dissolved")
@@ -39,81 +43,86 @@ roadway_information = os.path.join(facilities_streets, "RoadwayInformation")
 fleet = os.path.join(risk_fgdb, "Fleet")
 salt = os.path.join(risk_fgdb, "Salt")
 
+# Salt distances layers
+salt_5 = os.path.join(salt, "Salt_5")
+salt_10 = os.path.join(salt, "Salt_10")
+salt_15 = os.path.join(salt, "Salt_15")
+salt_20 = os.path.join(salt, "Salt_20")
+
+# Fleet distances layers
+fleet_5 = os.path.join(fleet, "Fleet_5")
+fleet_10 = os.path.join(fleet, "Fleet_10")
+fleet_15 = os.path.join(fleet, "Fleet_15")
+fleet_20 = os.path.join(fleet, "Fleet_20")
+
+# Roadway fields copied into SnowRisk: name, alias, type, length, and source field
+roadway_fields = [["ROAD_NAME", "ROAD_NAME", "Text", 255, "ROAD_NAME"],
+                  ["FC", "Functional Classification", "Text", 1, "FC"],
+                  ["AADT", "Annual Average Daily Traffic", "Double", 8, "AADT"],
+                  ["AADT_YR", "AADT Year", "Text", 4, "AADT_YR"],
+                  ["LN_MI", "Through Lane Miles", "Double", 8, "LN_MI"],
+                  ["LN_SPC_NBR", "Special Lane Count", "Double", 8, "LN_SPC_NBR"],
+                  ["LN_TOTALMI", "Total Lane Miles", "Double", 8, "LN_TOTALMI"],
+                  ["LNS", "Through Lane Count", "Short", 2, "LNS"],
+                  ["SMTD_DAY", "SMTD Day Service", "Text", 1, "SMTD_DAY"],
+                  ["SMTD_NIGHT", "SMTD Night Service", "Text", 1, "SMTD_NIGHT"],
+                  ["SMTD_SUPPL", "SMTD Supplemental Service", "Text", 1, "SMTD_SUPPL"],
+                  ["SNOW_CRASH", "Snow Crash Numbers", "Short", 2, "NUMB1"],
+                  ["SNOW_DIST", "Snow District", "Text", 3, "SNOW_DIST"],
+                  ["SNOW_FID", "Snow Route Identifier", "Text", 7, "SNOW_FID"],
+                  ["SNOW_RT_NBR", "SNOW_RT_NBR", "Text", 10, "SNOW__RT_NBR"],
+                  ["SNOW_SLOPE", "Calculated Profile Grade", "Double", 8, "SNOW_SLOPE"],
+                  ["SNOW_TYPE", "Snow Type (Priority)", "Text", 1, "SNOW_TYPE"],
+                  ["SNOW_TIME", "Calculated Plow-time (E-E based on Lane Miles)", "Double", 8, "SNOW_TIME"],
+                  ["SNOW_TRBL", "Snow Trouble Spot Justification", "Text", 2, "SNOW_TRBL"],
+                  ["SURF_TYP", "Original Surface Type", "Text", 50, "SURF_TYP"]]
+
+# Scoring lookups
+asphalt = frozenset({"501", "510", "520", "525", "530", "540", "550", "560", "600", "610", "615", "620", "625", "630", "640", "650"})
+oil_and_chip = frozenset({"300", "500"})
+surface_prefixes = {"7": 3,  # 3 - Concrete
+                    "8": 4}  # 4 - Brick
+troubles = {"12": 1,  # 1 - 12
+            "10": 2, "11": 2,  # 2 - 10,11
+            "07": 3, "13": 3,  # 3 - 7,13
+            "01": 4, "02": 4, "03": 4, "04": 4, "06": 4}  # 4 - 1,2,3,4,6
+classifications = {"7": 1,  # 1  - Local road or street
+                   "6": 2,  # 2 - Minor collector
+                   "5": 3,  # 3 - Major collector
+                   "4": 4, "3": 4}  # 4 - Arterials
+slope_breaks = (2, 3, 4)  # 1 - 0-2%, 2 - 2-3%, 3 - 3-4%, 4 - 4%+
+average_breaks = (750, 1400, 3100)  # 1 - Less than 750, 2 - 750 - 1400, 3 - > 1400 - 3100, 4 - 3100+
+
 
 @Logging.insert("Initialize", 1)
 def initialize():
     """Create a feature layer to work with"""
 
-    # Copy over roadway information
-    arcpy.FeatureClassToFeatureClass_conversion(roadway_information, risk_fgdb, "SnowRisk", "SNOW_DIST IS NOT NULL",
-                                                fr"ROAD_NAME 'ROAD_NAME' true true false 255 Text 0 0,First,#,{roadway_information},ROAD_NAME,0,75;"
-                                                fr"FC 'Functional Classification' true true false 1 Text 0 0,First,#,{roadway_information},FC,0,1;"
-                                                fr"AADT 'Annual Average Daily Traffic' true true false 8 Double 8 38,First,#,{roadway_information},AADT,-1,-1;"
-                                                fr"AADT_YR 'AADT Year' true true false 4 Text 0 0,First,#,{roadway_information},AADT_YR,0,4;"
-                                                fr"LN_MI 'Through Lane Miles' true true false 8 Double 8 38,First,#,{roadway_information},LN_MI,-1,-1;"
-                                                fr"LN_SPC_NBR 'Special Lane Count' true true false 8 Double 8 38,First,#,{roadway_information},LN_SPC_NBR,-1,-1;"
-                                                fr"LN_TOTALMI 'Total Lane Miles' true true false 8 Double 8 38,First,#,{roadway_information},LN_TOTALMI,-1,-1;"
-                                                fr"LNS 'Through Lane Count' true true false 8 Short 8 38,First,#,{roadway_information},LNS,-1,-1;"
-                                                fr"SMTD_DAY 'SMTD Day Service' true true false 1 Text 0 0,First,#,{roadway_information},SMTD_DAY,0,1;"
-                                                fr"SMTD_NIGHT 'SMTD Night Service' true true false 1 Text 0 0,First,#,{roadway_information},SMTD_NIGHT,0,1;"
-                                                fr"SMTD_SUPPL 'SMTD Supplemental Service' true true false 1 Text 0 0,First,#,{roadway_information},SMTD_SUPPL,0,1;"
-                                                fr"SNOW_CRASH 'Snow Crash Numbers' true true false 255 Short 0 0,First,#,{roadway_information},NUMB1,-1,-1;"
-                                                fr"SNOW_DIST 'Snow District' true true false 3 Text 0 0,First,#,{roadway_information},SNOW_DIST,0,3;"
-                                                fr"SNOW_FID 'Snow Route Identifier' true true false 7 Text 0 0,First,#,{roadway_information},SNOW_FID,0,7;"
-                                                fr"SNOW_RT_NBR 'SNOW_RT_NBR' true true false 10 Text 0 0,First,#,{roadway_information},SNOW__RT_NBR,0,10;"
-                                                fr"SNOW_SLOPE 'Calculated Profile Grade' true true false 8 Double 8 38,First,#,{roadway_information},SNOW_SLOPE,-1,-1;"
-                                                fr"SNOW_TYPE 'Snow Type (Priority)' true true false 1 Text 0 0,First,#,{roadway_information},SNOW_TYPE,0,1;"
-                                                fr"SNOW_TIME 'Calculated Plow-time (E-E based on Lane Miles)' true true false 8 Double 8 38,First,#,{roadway_information},SNOW_TIME,-1,-1;"
-                                                fr"SNOW_TRBL 'Snow Trouble Spot Justification' true true false 2 Text 0 0,First,#,{roadway_information},SNOW_TRBL,0,2;"
-                                                fr"SURF_TYP 'Original Surface Type' true true false 50 Text 0 0,First,#,{roadway_information},SURF_TYP,0,50")
+    # Copy over roadway information into the memory workspace; scoring works there and finalize() writes SnowRisk once
+    field_mapping = ";".join(f"{name} '{alias}' true true false {length} {field_type} 0 0,First,#,{roadway_information},{source}," + (f"0,{length}" if field_type == "Text" else "-1,-1")
+                             for name, alias, field_type, length, source in roadway_fields)
+    arcpy.FeatureClassToFeatureClass_conversion(roadway_information, "memory", "SnowRisk", "SNOW_DIST IS NOT NULL", field_mapping)
 
     # Add the fields to use
-    arcpy.AddFields_management(snow_risk, [["LN_TOTAL", "Short", "Total Lane Count"],
-                                           ["SINUOSITY", "Double", "Sinuosity"],
-                                           ["COF", "Double", "Total COF Score"],
-                                           ["COF_SAFETY", "Double", "Safety COF Score"],
-                                           ["COF_AADT", "Short", "AADT Score"],
-                                           ["COF_CRASH", "Short", "Crash Data Score"],
-                                           ["COF_FC", "Short", "FC Score"],
-                                           ["COF_SINE", "Short", "Sinuosity Score"],
-                                           ["COF_SLOPE", "Short", "Slope Score"],
-                                           ["COF_SMTD", "Short", "SMTD Bus Routes Score"],
-                                           ["COF_SURF", "Short", "Surface Type Score"],
-                                           ["COF_TRBL", "Short", "Trouble Spot Score"],
-                                           ["POF", "Double", "Total POF Score"],
-                                           ["POF_FLEET", "Short", "Distance to Fleet Score"],
-                                           ["POF_LANES", "Short", "Lane Count Score"],
-                                           ["POF_SALT", "Short", "Distance to Salt Score"],
-                                           ["POF_WEATHER", "Short", "Predicted Cumulative Precipitation"],
-                                           ["RISK", "Double", "Total Risk Score"],
-                                           ["RISK_SAFETY", "Double", "Safety Risk Score"]])
-    arcpy.MakeFeatureLayer_management(snow_risk, "SnowRisk")
-
-
-def RiskProcessor(risk_type, segment_list, field, name):
-    """Template for looping through rank lists and calculating fields"""
-    if risk_type and segment_list and field and name:
-        if risk_type == "consequence":
-            Logging.logger.info(f"------START {name}")
-            for segment in segment_list:
-                Logging.logger.info(f"---------START Rank {segment[1]}")
-                segment_selection = arcpy.SelectLayerByAttribute_management("SnowRisk", "NEW_SELECTION", segment[0])
-                arcpy.CalculateField_management(segment_selection, field, segment[1], "PYTHON3")
-                Logging.logger.info(f"---------FINISH Rank {segment[1]}")
-            Logging.logger.info(f"------FINISH {name}")
-        elif risk_type == "probability":
-            Logging.logger.info(f"------START {name}")
-            for segment in segment_list:
-                Logging.logger.info(f"---------START Rank {segment[1]}")
-                selection = arcpy.SelectLayerByLocation_management("SnowRisk", "HAVE_THEIR_CENTER_IN", segment[0], None, "NEW_SELECTION")
-                subset_selection = arcpy.SelectLayerByAttribute_management(selection, "SUBSET_SELECTION", "SNOW_FID <> 'NORTE'")
-                arcpy.CalculateField_management(subset_selection, field, segment[1], "PYTHON3")
-                Logging.logger.info(f"---------FINISH Rank {segment[1]}")
-            Logging.logger.info(f"------FINISH {name}")
-        else:
-            raise ValueError("Incorrect risk type")
-    else:
-        raise NameError
+    arcpy.AddFields_management(snow_risk_memory, [["LN_TOTAL", "Short", "Total Lane Count"],
+                                                  ["SINUOSITY", "Double", "Sinuosity"],
+                                                  ["COF", "Double", "Total COF Score"],
+                                                  ["COF_SAFETY", "Double", "Safety COF Score"],
+                                                  ["COF_AADT", "Short", "AADT Score"],
+                                                  ["COF_CRASH", "Short", "Crash Data Score"],
+                                                  ["COF_FC", "Short", "FC Score"],
+                                                  ["COF_SINE", "Short", "Sinuosity Score"],
+                                                  ["COF_SLOPE", "Short", "Slope Score"],
+                                                  ["COF_SMTD", "Short", "SMTD Bus Routes Score"],
+                                                  ["COF_SURF", "Short", "Surface Type Score"],
+                                                  ["COF_TRBL", "Short", "Trouble Spot Score"],
+                                                  ["POF", "Double", "Total POF Score"],
+                                                  ["POF_FLEET", "Short", "Distance to Fleet Score"],
+                                                  ["POF_LANES", "Short", "Lane Count Score"],
+                                                  ["POF_SALT", "Short", "Distance to Salt Score"],
+                                                  ["POF_WEATHER", "Short", "Predicted Cumulative Precipitation"],
+                                                  ["RISK", "Double", "Total Risk Score"],
+                                                  ["RISK_SAFETY", "Double", "Safety Risk Score"]])
 
 
 @Logging.insert("Consequence", 1)
@@ -131,110 +140,123 @@ def consequence_ranking():
     Sinuosity - How curved or winding the segment is
     """
 
-    # SMTD Bus Routes
-    routes = [["SNOW_FID = 'NORTE'", "0"],  # 0 - Not a snow route and no bus routes
-              ["SNOW_FID <> 'NORTE' AND (SMTD_DAY = '0' OR SMTD_NIGHT = '0')", "1"],  # 1 - No SMTD bus routes
-              ["SNOW_FID <> 'NORTE' AND (SMTD_DAY = '1' OR SMTD_NIGHT = '1')", "3"],  # 3 - Day or night
-              ["SNOW_FID <> 'NORTE' AND (SMTD_DAY = '2' OR SMTD_NIGHT = '2')", "4"]]  # 4 - Express SMTD bus routes like exchange/transfer areas
-
-    # Functional Classifications
-    classifications = [["SNOW_FID = 'NORTE'", "0"],  # 0 - NORTE
-                       ["SNOW_FID <> 'NORTE' AND FC = '7'", "1"],  # 1  - Local road or street
-                       ["SNOW_FID <> 'NORTE' AND FC = '6'", "2"],  # 2 - Minor collector
-                       ["SNOW_FID <> 'NORTE' AND FC = '5'", "3"],  # 3 - Major collector
-                       ["SNOW_FID <> 'NORTE' AND (FC = '4' OR FC='3')", "4"]]  # 4 - Arterials
-
-    # Slopes
-    slopes = [["SNOW_FID = 'NORTE'", "0"],  # 0 - NORTE
-              ["SNOW_FID <> 'NORTE' AND SNOW_SLOPE <= 1.999", "1"],  # 1 - 0-2%
-              ["SNOW_FID <> 'NORTE' AND (SNOW_SLOPE >= 2 AND SNOW_SLOPE <= 2.999)", "2"],  # 2 - 2-3%
-              ["SNOW_FID <> 'NORTE' AND (SNOW_SLOPE >= 3 AND SNOW_SLOPE <= 3.999)", "3"],  # 3 - 3-4%
-              ["SNOW_FID <> 'NORTE' AND SNOW_SLOPE >= 4", "4"]]  # 4 - 4%+
-
-    # Traffic Annual Averages (AADT)
-    averages = [["SNOW_FID = 'NORTE'", "0"],  # 0 - NORTE
-                ["SNOW_FID <> 'NORTE' AND (AADT >= 0 AND AADT <= 750)", "1"],  # 1 - Less than 750
-                ["SNOW_FID <> 'NORTE' AND (AADT >= 751 AND AADT <= 1400)", "2"],  # 2 - 750 - 1400
-                ["SNOW_FID <> 'NORTE' AND (AADT >= 1401 AND AADT <= 3100)", "3"],  # 3 - > 1400 - 3100
-                ["SNOW_FID <> 'NORTE' AND AADT > 3100", "4"]]  # 4 - 3100+
-
-    # Trouble Spot Justification
-    troubles = [["SNOW_FID = 'NORTE'", "0"],  # 0 - NORTE
-                ["SNOW_FID <> 'NORTE' AND SNOW_TRBL IN ('12')", "1"],  # 1 - 12
-                ["SNOW_FID <> 'NORTE' AND SNOW_TRBL IN ('10', '11')", "2"],  # 2 - 10,11
-                ["SNOW_FID <> 'NORTE' AND SNOW_TRBL IN ('07', '13')", "3"],  # 3 - 7,13
-                ["SNOW_FID <> 'NORTE' AND SNOW_TRBL IN ('01', '02', '03', '04', '06')", "4"]]  # 4 - 1,2,3,4,6
-
-    # Crash statistics
-    crashes = [["SNOW_FID = 'NORTE'", "0"],  # 0 - NORTE
-               ["SNOW_FID <> 'NORTE' AND SNOW_CRASH = 0", "1"],  # 1 - 0 crashes
-               ["SNOW_FID <> 'NORTE' AND SNOW_CRASH = 1", "2"],  # 2 - 1 crashes
-               ["SNOW_FID <> 'NORTE' AND SNOW_CRASH = 2", "3"],  # 3 - 2 crashes
-               ["SNOW_FID <> 'NORTE' AND SNOW_CRASH >= 3", "4"]]  # 4 - 3+ crashes
-
-    # Road materials
-    materials = [["SNOW_FID = 'NORTE'", "0"],  # 0 - NORTE
-                 ["SNOW_FID <> 'NORTE' AND SURF_TYP IN ('501', '510', '520', '525', '530', '540', '550', '560', '600', '610', '615', '620', '625', '630', '640', '650')", "1"],  # 1 - Asphalt
-                 ["SNOW_FID <> 'NORTE' AND (SURF_TYP = '300' OR SURF_TYP = '500')", "2"],  # 2 - Bituminous Surface Treatment (Oil & Chip)
-                 ["SNOW_FID <> 'NORTE' AND SURF_TYP LIKE '7%'", "3"],  # 3 - Concrete
-                 ["SNOW_FID <> 'NORTE' AND SURF_TYP LIKE '8%'", "4"]]  # 4 - Brick
-
-    # Sinuosity
-    curves = [["SINUOSITY <= 1.02 AND SINUOSITY > .98", "1"],  # Sinuosity < 1 does not exist by definition but converting float-->double makes 1 values equal .999
-              ["SINUOSITY <= 1.05 AND SINUOSITY > 1.02", "2"],
-              ["SINUOSITY <= 1.1 AND SINUOSITY > 1.05", "3"],
-              ["SINUOSITY <= 29 AND SINUOSITY > 1.1", "4"]]
-
-    @Logging.insert("Sinuosity", 2)
-    def sinuosity():
-        """Calculates the sinuosity value of each segment before giving it a rank"""
-
-        # Sinuosity distance formula expressions; loop distance splits closed loops into 2 segments equal to 50% of the shape length and separately calculates the linear distance
-        loop_distance = "!Shape.length!/(math.sqrt((!Shape.firstpoint.X!-!Shape!.positionAlongLine(0.5, True).firstpoint.X)**2 +" \
-                        "(!Shape.firstpoint.Y!-!Shape!.positionAlongLine(0.5, True).firstpoint.Y)**2) + " \
-                        "math.sqrt((!Shape!.positionAlongLine(0.5, True).firstpoint.X-!Shape.lastpoint.X!)**2 +" \
-                        "(!Shape!.positionAlongLine(0.5, True).firstpoint.Y-!Shape.lastpoint.Y!)**2))"
-
-        # Calculate sinuosity (curve length/linear length)
-        selection_sinuosity = arcpy.SelectLayerByAttribute_management("SnowRisk", "NEW_SELECTION", "Shape_Length > 0")
-        arcpy.CalculateField_management(selection_sinuosity, "SINUOSITY", loop_distance, "PYTHON3")
-
-        # Calculate sinuosity if it has returned null thus far
-        selection_nulls = arcpy.SelectLayerByAttribute_management("SnowRisk", "NEW_SELECTION", "SINUOSITY IS NULL AND Shape_Length > 0")
-        arcpy.CalculateField_management(selection_nulls, "SINUOSITY", "30", "PYTHON3")
-
-    @Logging.insert("COF Total", 2)
-    def total_cof_scores():
+    def route_score(day, night):
+        """SMTD Bus Routes"""
+        services = (day, night)
+        if "2" in services:  # 4 - Express SMTD bus routes like exchange/transfer areas
+            return 4
+        elif "1" in services:  # 3 - Day or night
+            return 3
+        elif "0" in services:  # 1 - No SMTD bus routes
+            return 1
+        return None
+
+    def slope_score(slope):
+        """Slopes"""
+        if slope is None:
+            return None
+        return bisect.bisect_right(slope_breaks, slope) + 1
+
+    def average_score(aadt):
+        """Traffic Annual Averages (AADT)"""
+        if aadt is None or aadt < 0:
+            return None
+        return bisect.bisect_left(average_breaks, aadt) + 1
+
+    def crash_score(crash):
+        """Crash statistics"""
+        if crash is None or crash < 0:
+            return None
+        return min(crash, 3) + 1  # 1 - 0 crashes, 2 - 1 crash, 3 - 2 crashes, 4 - 3+ crashes
+
+    def material_score(surface):
+        """Road materials"""
+        if surface in asphalt:  # 1 - Asphalt
+            return 1
+        elif surface in oil_and_chip:  # 2 - Bituminous Surface Treatment (Oil & Chip)
+            return 2
+        elif surface:  # 3 - Concrete, 4 - Brick
+            return surface_prefixes.get(surface[:1])
+        return None
+
+    def curve_score(curve):
+        """Sinuosity"""
+        if curve is None:
+            return None
+        elif 1.1 < curve <= 29:
+            return 4
+        elif 1.05 < curve <= 1.1:
+            return 3
+        elif 1.02 < curve <= 1.05:
+            return 2
+        elif .98 < curve <= 1.02:  # Sinuosity < 1 does not exist by definition but converting float-->double makes 1 values equal .999
+            return 1
+        return None
+
+    def total_cof_scores(smtd, fc, slope, aadt, trouble, crash, surface, sine):
         """Calculate Total COF Score using the risk assessment process"""
+        if None in (smtd, fc, slope, aadt, trouble, crash, surface, sine):
+            return None, None
 
         # Calculate the two weighed sections of COF
-        safety_factor = "!COF_FC!+!COF_SLOPE!+!COF_AADT!+!COF_TRBL!+!COF_CRASH!"
-        safety_factor_average = f"{safety_factor}/5"
-        social_factor = "!COF_SMTD!+!COF_FC!+!COF_SLOPE!+!COF_AADT!+!COF_TRBL!+!COF_CRASH!+!COF_SURF!+!COF_SINE!"
+        safety_factor = fc + slope + aadt + trouble + crash
+        safety_factor_average = safety_factor / 5
+        social_factor = smtd + fc + slope + aadt + trouble + crash + surface + sine
         safety_factor_total = 20
         safety_factor_average_total = 20
         social_factor_total = 32
         safety_factor_weight = .75
         social_factor_weight = .25
 
-        # Calculate final COF, Risk, and Risk with only safety factors used
-        cof = f"(((({safety_factor})/{safety_factor_total})*{safety_factor_weight}) + ((({social_factor})/{social_factor_total})*{social_factor_weight}))*4"
-        cof_safety = f"(({safety_factor_average})/{safety_factor_average_total})*4"
-        selection = arcpy.SelectLayerByAttribute_management("SnowRisk", "NEW_SELECTION", "SNOW_FID <> 'NORTE'")
-        arcpy.CalculateField_management(selection, "COF", f"(round({cof}*10))/10", "PYTHON3")
-        arcpy.CalculateField_management(selection, "COF_SAFETY", f"(round({cof_safety}*10))/10", "PYTHON3")
+        # Calculate final COF and COF with only safety factors used
+        cof = (((safety_factor / safety_factor_total) * safety_factor_weight) + ((social_factor / social_factor_total) * social_factor_weight)) * 4
+        cof_safety = (safety_factor_average / safety_factor_average_total) * 4
+        return round(cof * 10) / 10, round(cof_safety * 10) / 10
+
+    def sinuosity(shape):
+        """Calculates the sinuosity value of a segment before giving it a rank"""
+        if shape is None or shape.length <= 0:
+            return None
+
+        # Loop distance splits closed loops into 2 segments equal to 50% of the shape length and separately calculates the linear distance
+        midpoint = shape.positionAlongLine(0.5, True).firstPoint
+        loop_distance = math.hypot(shape.firstPoint.X - midpoint.X, shape.firstPoint.Y - midpoint.Y) + \
+            math.hypot(midpoint.X - shape.lastPoint.X, midpoint.Y - shape.lastPoint.Y)
+
+        # Calculate sinuosity (curve length/linear length), or 30 when there is no linear length
+        return shape.length / loop_distance if loop_distance else 30
+
+    @Logging.insert("Categories", 2)
+    def category_scores():
+        """Calculate sinuosity and score every COF category and the COF totals in a single pass"""
+
+        fields = ["SNOW_FID", "SMTD_DAY", "SMTD_NIGHT", "FC", "SNOW_SLOPE", "AADT", "SNOW_TRBL", "SNOW_CRASH", "SURF_TYP", "SHAPE@", "SINUOSITY",
+                  "COF_SMTD", "COF_FC", "COF_SLOPE", "COF_AADT", "COF_TRBL", "COF_CRASH", "COF_SURF", "COF_SINE", "COF", "COF_SAFETY"]
+        with arcpy.da.UpdateCursor(snow_risk_memory, fields) as cursor:
+            for row in cursor:
+                snow_fid, smtd_day, smtd_night, fc, slope, aadt, trouble, crash, surface, shape = row[:10]
+                curve = sinuosity(shape)
+                sine = curve_score(curve)
+
+                # NORTE segments are not snow routes and score 0 in every category but sinuosity; only snow routes get a total
+                if snow_fid == "NORTE":
+                    row[10:] = [curve, 0, 0, 0, 0, 0, 0, 0, sine, None, None]
+                elif snow_fid is None:
+                    row[10:] = [curve, None, None, None, None, None, None, None, sine, None, None]
+                else:
+                    scores = [route_score(smtd_day, smtd_night),
+                              classifications.get(fc),
+                              slope_score(slope),
+                              average_score(aadt),
+                              troubles.get(trouble),
+                              crash_score(crash),
+                              material_score(surface),
+                              sine]
+                    row[10:] = [curve] + scores + list(total_cof_scores(*scores))
+                cursor.updateRow(row)
 
     # Scoring
-    RiskProcessor("consequence", routes, "COF_SMTD", "Bus Routes")
-    RiskProcessor("consequence", classifications, "COF_FC", "Functional Classifications")
-    RiskProcessor("consequence", slopes, "COF_SLOPE", "Slopes")
-    RiskProcessor("consequence", averages, "COF_AADT", "AADT")
-    RiskProcessor("consequence", troubles, "COF_TRBL", "Trouble Spots")
-    RiskProcessor("consequence", crashes, "COF_CRASH", "Crash Data")
-    RiskProcessor("consequence", materials, "COF_SURF", "Surface Materials")
-    sinuosity()
-    RiskProcessor("consequence", curves, "COF_SINE", "Sinuosity")
-    total_cof_scores()
+    category_scores()
 
 
 @Logging.insert("Probability", 1)
@@ -248,84 +270,139 @@ def probability_ranking():
 
     """
 
-    # Salt distances layers
-    salt_5 = os.path.join(salt, "Salt_5")
-    salt_10 = os.path.join(salt, "Salt_10")
-    salt_15 = os.path.join(salt, "Salt_15")
-    salt_20 = os.path.join(salt, "Salt_20")
-
-    # Fleet distances layers
-    fleet_5 = os.path.join(fleet, "Fleet_5")
-    fleet_10 = os.path.join(fleet, "Fleet_10")
-    fleet_15 = os.path.join(fleet, "Fleet_15")
-    fleet_20 = os.path.join(fleet, "Fleet_20")
-
-    # Calculate total number of lanes
-    arcpy.CalculateField_management("SnowRisk", "LN_TOTAL", "!LNS!+!LN_SPC_NBR!", "PYTHON3")
-
     # Distance to salt domes
-    salt_domes = [[salt_5, "1"],  # 1 - 5 minutes or less
-                  [salt_10, "2"],  # 2 - 10 minutes or less
-                  [salt_15, "3"],  # 3 - 15 minutes or less
-                  [salt_20, "4"]]  # 4 - 20 minutes or less
+    salt_domes = [[salt_5, 1],  # 1 - 5 minutes or less
+                  [salt_10, 2],  # 2 - 10 minutes or less
+                  [salt_15, 3],  # 3 - 15 minutes or less
+                  [salt_20, 4]]  # 4 - 20 minutes or less
 
     # Distance to fleet garage
-    fleet_garages = [[fleet_5, "1"],  # 1 - 5 minutes or less
-                     [fleet_10, "2"],  # 2 - 10 minutes or less
-                     [fleet_15, "3"],  # 3 - 15 minutes or less
-                     [fleet_20, "4"]]  # 4 - 20 minutes or less
-
-    # Total number of lanes
-    lanes = [["LN_TOTAL <= 2 OR LN_TOTAL is NULL", "1"],
-             ["LN_TOTAL = 3", "2"],
-             ["LN_TOTAL = 4", "3"],
-             ["LN_TOTAL >= 5", "4"]]
-
-    @Logging.insert("Total POF", 2)
-    def total_pof_scores():
+    fleet_garages = [[fleet_5, 1],  # 1 - 5 minutes or less
+                     [fleet_10, 2],  # 2 - 10 minutes or less
+                     [fleet_15, 3],  # 3 - 15 minutes or less
+                     [fleet_20, 4]]  # 4 - 20 minutes or less
+
+    def lane_score(lanes):
+        """Total number of lanes"""
+        if lanes is None or lanes <= 2:  # 1 - 2 lanes or less
+            return 1
+        return min(lanes, 5) - 1  # 2 - 3 lanes, 3 - 4 lanes, 4 - 5+ lanes
+
+    def travel_time_scores(areas, name):
+        """Join snow routes to every travel time area at once and keep the best (lowest) rank of each segment"""
+        merged_areas = os.path.join("memory", name)
+        arcpy.CreateFeatureclass_management("memory", name, "POLYGON", spatial_reference=arcpy.Describe(areas[0][0]).spatialReference)
+        arcpy.AddField_management(merged_areas, "RANK", "SHORT")
+        with arcpy.da.InsertCursor(merged_areas, ["SHAPE@", "RANK"]) as insert_cursor:
+            for area, rank in areas:
+                with arcpy.da.SearchCursor(area, ["SHAPE@"]) as search_cursor:
+                    for row in search_cursor:
+                        insert_cursor.insertRow([row[0], rank])
+
+        joined_areas = os.path.join("memory", f"{name}_Join")
+        arcpy.SpatialJoin_analysis("SnowRoutes", merged_areas, joined_areas, "JOIN_ONE_TO_MANY", "KEEP_COMMON", match_option="HAVE_THEIR_CENTER_IN")
+        scores = {}
+        with arcpy.da.SearchCursor(joined_areas, ["TARGET_FID", "RANK"]) as cursor:
+            for segment, rank in cursor:
+                scores[segment] = min(rank, scores.get(segment, rank))
+        return scores
+
+    def total_pof_scores(salt_score, fleet_score, lanes_score, cof, cof_safety):
         """Calculate the two weighed section using the risk assessment process"""
-        arcpy.SelectLayerByAttribute_management("SnowRisk", "CLEAR_SELECTION")
-        mechanical_factor = "!POF_SALT!+!POF_FLEET!"
-        weather_factor = "!POF_SALT!+!POF_LANES!"
+        if None in (salt_score, fleet_score, lanes_score):
+            return None, None, None
+        mechanical_factor = salt_score + fleet_score
+        weather_factor = salt_score + lanes_score
         mechanical_factor_total = 8
         weather_factor_total = 8
         mechanical_factor_weight = .50
         weather_factor_weight = .50
 
         # Calculate final POF and risk score
-        pof = f"(((({mechanical_factor})/{mechanical_factor_total})*{mechanical_factor_weight}) + ((({weather_factor})/{weather_factor_total})*{weather_factor_weight}))*4"
-        arcpy.CalculateFields_management("SnowRisk", "PYTHON3", [["POF", f"(round({pof}*10)/10)"],
-                                                                 ["RISK", "(round((!COF!*!POF!)*10)/10)"],
-                                                                 ["RISK_SAFETY", "(round((!COF_SAFETY!*!POF!)*10)/10)"]])
+        pof = round((((mechanical_factor / mechanical_factor_total) * mechanical_factor_weight) + ((weather_factor / weather_factor_total) * weather_factor_weight)) * 4 * 10) / 10
+        risk = None if cof is None else round(cof * pof * 10) / 10
+        risk_safety = None if cof_safety is None else round(cof_safety * pof * 10) / 10
+        return pof, risk, risk_safety
+
+    @Logging.insert("Scores", 2)
+    def pof_scores():
+        """Score distances and lanes, and calculate POF and risk in a single pass"""
+
+        # Skip the spatial joins when there are no snow routes to score
+        if int(arcpy.GetCount_management("SnowRoutes")[0]):
+            salt_scores = travel_time_scores(salt_domes, "SaltDomes")
+            fleet_scores = travel_time_scores(fleet_garages, "FleetGarages")
+        else:
+            salt_scores = fleet_scores = {}
+        fields = ["OID@", "LNS", "LN_SPC_NBR", "COF", "COF_SAFETY", "POF_SALT", "POF_FLEET", "LN_TOTAL", "POF_LANES", "POF", "RISK", "RISK_SAFETY"]
+        with arcpy.da.UpdateCursor(snow_risk_memory, fields) as cursor:
+            for row in cursor:
+                oid, through_lanes, special_lanes, cof, cof_safety = row[:5]
+                salt_score = salt_scores.get(oid)
+                fleet_score = fleet_scores.get(oid)
+                total_lanes = None if through_lanes is None or special_lanes is None else int(through_lanes + special_lanes)
+                lanes_score = lane_score(total_lanes)
+                row[5:] = [salt_score, fleet_score, total_lanes, lanes_score] + list(total_pof_scores(salt_score, fleet_score, lanes_score, cof, cof_safety))
+                cursor.updateRow(row)
+
+    # Snow routes only; NORTE segments are filtered once here instead of in every join
+    arcpy.MakeFeatureLayer_management(snow_risk_memory, "SnowRoutes", "SNOW_FID <> 'NORTE'")
 
     # Scoring
-    RiskProcessor("probability", salt_domes, "POF_SALT", "Salt Domes")
-    RiskProcessor("probability", fleet_garages, "POF_FLEET", "Fleet Garages")
-    RiskProcessor("consequence", lanes, "POF_LANES", "Lane Counts")
-    total_pof_scores()
+    pof_scores()
+
+
+@Logging.insert("Finalize", 1)
+def finalize():
+    """Write the scored segments from the memory workspace to SnowRisk"""
+
+    # Refresh an existing SnowRisk in place; truncating keeps the schema and skips rebuilding the feature class
+    if arcpy.Exists(snow_risk):
+        fields = ["SHAPE@"] + [field.name for field in arcpy.ListFields(snow_risk_memory) if field.editable and field.type not in ("OID", "Geometry")]
+        arcpy.TruncateTable_management(snow_risk)
+
+        # Drop the spatial index while loading so it is built once afterwards instead of updated on every insert
+        if arcpy.Describe(snow_risk).hasSpatialIndex:
+            arcpy.RemoveSpatialIndex_management(snow_risk)
+
+        # A single edit session commits the inserted rows once instead of per insert
+        with arcpy.da.Editor(risk_fgdb):
+            with arcpy.da.SearchCursor(snow_risk_memory, fields) as search_cursor, arcpy.da.InsertCursor(snow_risk, fields) as insert_cursor:
+                for row in search_cursor:
+                    insert_cursor.insertRow(row)
+        arcpy.AddSpatialIndex_management(snow_risk)
+    else:
+        arcpy.CopyFeatures_management(snow_risk_memory, snow_risk)
 
 
 @Logging.insert("Risk Minor", 1)
 def risk_minor():
     """Create a risk scores using only minor arterials and local roads"""
 
-    arcpy.FeatureClassToFeatureClass_conversion(snow_risk, risk_fgdb, "SnowRiskMinor", "FC IN ('6', '7')")
-    arcpy.MakeFeatureLayer_management(snow_risk_minor, "SnowRiskMinor")
+    # Read from the memory copy finalize() wrote to SnowRisk rather than reading SnowRisk back off disk
+    arcpy.FeatureClassToFeatureClass_conversion(snow_risk_memory, risk_fgdb, "SnowRiskMinor", "FC IN ('6', '7')")
 
     # COF without AADT and FC
-    safety_factor_minor = "!COF_SLOPE!+!COF_TRBL!+!COF_CRASH!"
-    social_factor_minor = "!COF_SMTD!+!COF_SLOPE!+!COF_TRBL!+!COF_CRASH!+!COF_SURF!+!COF_SINE!"
     safety_factor_total = 12
     social_factor_total = 24
     safety_factor_weight = .75
     social_factor_weight = .25
-    cof_minor = f"(((({safety_factor_minor})/{safety_factor_total})*{safety_factor_weight}) + ((({social_factor_minor})/{social_factor_total})*{social_factor_weight}))*4"
 
-    # Calculate COF and Risk
-    selection_minor = arcpy.SelectLayerByAttribute_management("SnowRiskMinor", "NEW_SELECTION", "SNOW_FID <> 'NORTE'")
-    arcpy.CalculateField_management(selection_minor, "COF", f"round(({cof_minor}), 2)", "PYTHON3")
-    arcpy.CalculateField_management(selection_minor, "RISK", "round((!COF!*!POF!), 2)", "PYTHON3")
-    arcpy.Dissolve_management("SnowRiskMinor", snow_risk_minor_dissolved, ["ROAD_NAME", "SNOW_TYPE", "SNOW_DIST"], [["COF", "MEAN"], ["POF", "MEAN"], ["RISK", "MEAN"]], "SINGLE_PART")
+    # Calculate COF and Risk in place on the copied segments
+    fields = ["COF_SMTD", "COF_SLOPE", "COF_TRBL", "COF_CRASH", "COF_SURF", "COF_SINE", "POF", "COF", "RISK"]
+    with arcpy.da.UpdateCursor(snow_risk_minor, fields, "SNOW_FID <> 'NORTE'") as cursor:
+        for row in cursor:
+            smtd, slope, trouble, crash, surface, sine, pof = row[:7]
+            if None in (smtd, slope, trouble, crash, surface, sine):
+                cof_minor = None
+            else:
+                safety_factor_minor = slope + trouble + crash
+                social_factor_minor = smtd + slope + trouble + crash + surface + sine
+                cof_minor = round((((safety_factor_minor / safety_factor_total) * safety_factor_weight) + ((social_factor_minor / social_factor_total) * social_factor_weight)) * 4, 2)
+            row[7] = cof_minor
+            row[8] = None if cof_minor is None or pof is None else round(cof_minor * pof, 2)
+            cursor.updateRow(row)
+    arcpy.Dissolve_management(snow_risk_minor, snow_risk_minor_dissolved, ["ROAD_NAME", "SNOW_TYPE", "SNOW_DIST"], [["COF", "MEAN"], ["POF", "MEAN"], ["RISK", "MEAN"]], "SINGLE_PART")
 
 
 @Logging.insert("Risk Rank", 1)
@@ -333,80 +410,60 @@ def risk_rank():
     """Rank risk scores for minor roads, descending order (highest rank = highest score)"""
 
     # Dissolve SnowRisk
-    arcpy.MakeFeatureLayer_management(snow_risk, "SnowRisk")
-    arcpy.Dissolve_management(snow_risk, snow_rank, ["SNOW_DIST", "SNOW_TYPE", "ROAD_NAME", "SNOW_RT_NBR"], [["COF", "MEAN"], ["POF", "MEAN"], ["RISK", "MEAN"], ["AADT", "MEAN"],
-                                                                                                             ["LN_TOTALMI", "SUM"]])
+    arcpy.Dissolve_management(snow_risk_memory, snow_rank, ["SNOW_DIST", "SNOW_TYPE", "ROAD_NAME", "SNOW_RT_NBR"], [["COF", "MEAN"], ["POF", "MEAN"], ["RISK", "MEAN"], ["AADT", "MEAN"],
+                                                                                                                    ["LN_TOTALMI", "SUM"]])
 
     # Add three rank fields, one for total, one for within its district, and one for within its route; also add a field for the first 3 digits of the route number and a full name
-    arcpy.MakeFeatureLayer_management(snow_rank, "SnowRank")
-    arcpy.AddFields_management("SnowRank", [["SNOW_RT_SHORT", "SHORT", "Snow Route Short", "4", "0"],
-                                            ["SNOW_RT_NAME", "TEXT", "Snow Route Name", "40", "0"],
-                                            ["RANK", "SHORT", "Total Rank", "4", "0"],
-                                            ["RANK_DISTRICT", "SHORT", "District Rank", "4", "0"],
-                                            ["RANK_ROUTE", "SHORT", "Route Rank", "4", "0"]])
-
-    # Template for ranking
-    def ranking(table, field):
-        rank = 1
-        clause = (None, "ORDER BY MEAN_COF DESC")
-        with arcpy.da.UpdateCursor(table, field, sql_clause=clause) as cursor:
-            for score in cursor:
-                score[0] = rank
-                cursor.updateRow(score)
-                rank += 1
-        del cursor
-
-    # Total rank
-    ranking("SnowRank", "RANK")
-
-    # Rank by district then by type/priority in that district
-    districts = ["D1", "D2", "D3", "D4", "D5", "D6", "CBD"]
-    subdistricts = ["101", "102", "201", "202", "301", "302", "401", "402", "501", "601", "602", "701", "702"]
-    for district in districts:
-        Logging.logger.info(f"------START {district}")
-        selected_districts = arcpy.SelectLayerByAttribute_management(snow_rank, "NEW_SELECTION", f"SNOW_DIST = '{district}'")
-        ranking(selected_districts, "RANK_DISTRICT")
-
-        for subdistrict in subdistricts:
-            Logging.logger.info(f"---------START Subdistrict {subdistrict}")
-            selected_priorities = arcpy.SelectLayerByAttribute_management(snow_rank, "NEW_SELECTION", f"SNOW_RT_NBR LIKE '{subdistrict}'")
-            ranking(selected_priorities, "RANK_ROUTE")
-            Logging.logger.info(f"---------FINISH Subdistrict {subdistrict}")
-        Logging.logger.info(f"------FINISH {district}")
-
-    # Calculate the first three digits of the route number
-    arcpy.CalculateField_management(snow_rank, "SNOW_RT_SHORT", "!SNOW_RT_NBR![:3]", "PYTHON3", )
-
-    # Calculate the district name, e.g. District 1 Section A
-    code_block = """def route(field):
-        if field[2] == "1":
-            letter = "A"
-        elif field[2] == "2":
-            letter = "B"
-        else:
-            letter = "0"
-
-        number = field[0]
-        name = f"District {number} Subgroup {letter}"
-        return name"""
-    arcpy.CalculateField_management(snow_rank, "SNOW_RT_NAME", "route(!SNOW_RT_NBR!)", "PYTHON3", code_block)
+    arcpy.AddFields_management(snow_rank, [["SNOW_RT_SHORT", "SHORT", "Snow Route Short", "4", "0"],
+                                           ["SNOW_RT_NAME", "TEXT", "Snow Route Name", "40", "0"],
+                                           ["RANK", "SHORT", "Total Rank", "4", "0"],
+                                           ["RANK_DISTRICT", "SHORT", "District Rank", "4", "0"],
+                                           ["RANK_ROUTE", "SHORT", "Route Rank", "4", "0"]])
+
+    def route_name(route):
+        """Calculate the district name, e.g. District 1 Subgroup A"""
+        if not route or len(route) < 3:
+            return None
+        letter = {"1": "A", "2": "B"}.get(route[2], "0")
+        return f"District {route[0]} Subgroup {letter}"
+
+    # Rank by total, by district, and by route subdistrict and fill in the route short number and name in one pass; every rank orders by MEAN_COF so one sorted cursor serves all three
+    districts = {"D1", "D2", "D3", "D4", "D5", "D6", "CBD"}
+    subdistricts = {"101", "102", "201", "202", "301", "302", "401", "402", "501", "601", "602", "701", "702"}
+    district_ranks = collections.defaultdict(int)
+    route_ranks = collections.defaultdict(int)
+    clause = (None, "ORDER BY MEAN_COF DESC")
+    with arcpy.da.Editor(risk_fgdb):
+        fields = ["SNOW_DIST", "SNOW_RT_NBR", "RANK", "RANK_DISTRICT", "RANK_ROUTE", "SNOW_RT_SHORT", "SNOW_RT_NAME"]
+        with arcpy.da.UpdateCursor(snow_rank, fields, sql_clause=clause) as cursor:
+            for rank, row in enumerate(cursor, 1):
+                district, route = row[:2]
+                subdistrict = route[:3] if route else None
+                row[2:] = [rank, None, None, int(subdistrict) if subdistrict and subdistrict.isdigit() else None, route_name(route)]
+                if district in districts:
+                    district_ranks[district] += 1
+                    row[3] = district_ranks[district]
+                if subdistrict in subdistricts:
+                    route_ranks[subdistrict] += 1
+                    row[4] = route_ranks[subdistrict]
+                cursor.updateRow(row)
 
 
 if __name__ == "__main__":
-    traceback_info = traceback.format_exc()
     try:
         Logging.logger.info("Script Execution Started")
         initialize()
         consequence_ranking()
         probability_ranking()
+        finalize()
         risk_minor()
         risk_rank()
+        arcpy.Compact_management(risk_fgdb)  # Reclaim the space left by truncating and overwriting the outputs
         Logging.logger.info("Script Execution Finished")
-    except (IOError, NameError, KeyError, IndexError, TypeError, UnboundLocalError, ValueError):
-        Logging.logger.info(traceback_info)
-    except NameError:
-        print(traceback_info)
     except arcpy.ExecuteError:
         Logging.logger.error(arcpy.GetMessages(2))
-    except:
-        Logging.logger.info("An unspecified exception occurred")
+    except (IOError, NameError, KeyError, IndexError, TypeError, UnboundLocalError, ValueError):
+        Logging.logger.error(traceback.format_exc())
+    except Exception:
+        Logging.logger.error("An unspecified exception occurred")
+        Logging.logger.error(traceback.format_exc())